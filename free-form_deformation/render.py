@@ -3,6 +3,7 @@ import argparse
 import numpy as np
 import random
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 # PyTorch
@@ -20,7 +21,7 @@ from tensorboardX import SummaryWriter
 import pytorch3d
 #from pytorch3d import _C
 from pytorch3d.io import load_obj, save_obj, load_objs_as_meshes
-from pytorch3d.structures import Meshes                                                 # メッシュ関連
+from pytorch3d.structures import Meshes, join_meshes_as_batch                          # メッシュ関連
 #from pytorch3d.structures import Textures                                               # テクスチャー関連
 from pytorch3d.renderer import look_at_view_transform, OpenGLPerspectiveCameras         # カメラ関連
 from pytorch3d.renderer import PointLights, DirectionalLights                           # ライト関連
@@ -37,6 +38,7 @@ from pygem import FFD
 # 自作モジュール
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm, save_plot3d_mesh_img, get_plot3d_mesh_img, save_mesh_obj
+from utils.ffd import FFDTorch
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -49,6 +51,7 @@ if __name__ == '__main__':
     parser.add_argument('--tensorboard_dir', type=str, default="tensorboard", help="TensorBoard のディレクトリ")
 
     parser.add_argument("--render_steps", type=int, default=100)
+    parser.add_argument("--n_save_mesh_steps", type=int, default=10, help="FFD 変形したメッシュを obj ファイルに保存するステップ間隔（0 以下で最終ステップのみ保存）")
     parser.add_argument("--window_size", type=int, default=512)
     parser.add_argument('--shader', choices=['soft_silhouette_shader', 'soft_phong_shader', 'textured_soft_phong_shader'], default="textured_soft_phong_shader", help="shader の種類")
     parser.add_argument("--light_pos_x", type=float, default=0.0)
@@ -57,6 +60,7 @@ if __name__ == '__main__':
     parser.add_argument("--camera_dist", type=float, default=2.7)
     parser.add_argument("--camera_elev", type=float, default=25.0)
     parser.add_argument("--camera_azim", type=float, default=150.0)
+    parser.add_argument('--perspective_correct', action='store_true', help="ラスタライズ時に重心座標の透視補正を行う")
 
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
@@ -125,19 +129,20 @@ if __name__ == '__main__':
     #================================    
     # メッシュファイルの読み込み / メッシュ : pytorch3d.structures.meshes.Meshes 型
     mesh = load_objs_as_meshes( [args.mesh_file], device = device )
+    mesh_faces = mesh.faces_packed()
     if( args.debug ):
         print( "mesh.num_verts_per_mesh() : ", mesh.num_verts_per_mesh() )
         print( "mesh.faces_packed().shape : ", mesh.faces_packed().shape )
 
     # メッシュの描写
     save_plot3d_mesh_img( mesh, os.path.join(args.results_dir, args.exper_name, "mesh.png" ), "mesh" )
-    save_mesh_obj( mesh.verts_packed(), mesh.faces_packed(), os.path.join(args.results_dir, args.exper_name, "mesh.obj" ) )
+    save_mesh_obj( mesh.verts_packed(), mesh_faces, os.path.join(args.results_dir, args.exper_name, "mesh.obj" ) )
     
     # メッシュのテクスチャー / テクスチャー : Tensor 型
     if( args.shader == "textured_soft_phong_shader" ):
         texture = mesh.textures.maps_padded()
         print( "texture.shape : ", texture.shape )  # torch.Size([1, 1024, 1024, 3])
-        save_image( texture.transpose(1,3).transpose(2,3), os.path.join(args.results_dir, args.exper_name, "texture.png" ) )
+        save_image( texture.permute(0,3,1,2), os.path.join(args.results_dir, args.exper_name, "texture.png" ) )
     elif( args.shader == "soft_phong_shader" ):
         from pytorch3d.structures import Textures
         
@@ -168,14 +173,10 @@ if __name__ == '__main__':
 
     # 制御点の変位を制御するために、`array_mu_x`, `array_mu_y`, `array_mu_z` の値を変えれば良い
     if( args.ffd_param_file == "" ):
-        x_min = torch.min( mesh.verts_packed().squeeze()[:,0] ).detach().cpu().numpy()
-        x_max = torch.max( mesh.verts_packed().squeeze()[:,0] ).detach().cpu().numpy()
-        y_min = torch.min( mesh.verts_packed().squeeze()[:,1] ).detach().cpu().numpy()
-        y_max = torch.max( mesh.verts_packed().squeeze()[:,1] ).detach().cpu().numpy()
-        z_min = torch.min( mesh.verts_packed().squeeze()[:,2] ).detach().cpu().numpy()
-        z_max = torch.max( mesh.verts_packed().squeeze()[:,2] ).detach().cpu().numpy()
-        ffd.box_length = [ x_max - x_min, y_max - y_min, z_max - z_min ]
-        ffd.box_origin = [ x_min, y_min, z_min ]
+        # xyz 各軸の最小値・最大値をまとめて計算し、CPU への転送も１回で行う
+        verts_min, verts_max = torch.stack( [ torch.min( mesh.verts_packed(), dim = 0 )[0], torch.max( mesh.verts_packed(), dim = 0 )[0] ] ).detach().cpu().numpy()
+        ffd.box_length = verts_max - verts_min
+        ffd.box_origin = verts_min
     if( args.debug ):
         # FFD オブジェクトの内容
         # conversion_unit = 1.0
@@ -192,9 +193,21 @@ if __name__ == '__main__':
         print( "ffd.array_mu_z.shape : \n", ffd.array_mu_z.shape )
         print( "ffd.control_points().shape : \n", ffd.control_points().shape )  # (8, 3)
 
+    # PyGeM の FFD パラメーターから、GPU 上で FFD 変形を行うモジュールを作成
+    # 制御点の変位 array_mu_x, array_mu_y, array_mu_z は shape = [L+1,M+1,N+1,3] の ffd_torch.mu にまとめる
+    ffd_torch = FFDTorch(
+        array_mu = np.stack( [ffd.array_mu_x, ffd.array_mu_y, ffd.array_mu_z], axis = -1 ),
+        box_origin = ffd.position_vertices[0],
+        box_edges = ffd.position_vertices[1:] - ffd.position_vertices[0],
+    ).to(device)
+
     # __call__(src_pts) を呼び出すことで、指定された頂点の FFD 変形を実行
     # src_pts (numpy.ndarray) : the array of dimensions (n_points, 3) containing the points to deform. The points have to be arranged by row.
-    mesh_verts_ffd = ffd( mesh.verts_packed().clone().cpu().numpy() )
+    #mesh_verts_ffd = ffd( mesh.verts_packed().clone().cpu().numpy() )
+
+    # PyGeM の FFD.__call__() は CPU(numpy) 上での計算になるので、頂点を GPU 上に置いたまま FFD 変形を行う
+    with torch.no_grad():
+        mesh_verts_ffd = ffd_torch( mesh.verts_packed() )
 
     # ffd.perform() でも実行可能
     #ffd.perform()
@@ -204,14 +217,10 @@ if __name__ == '__main__':
         print( "mesh_verts_ffd.shape : ", mesh_verts_ffd.shape )
 
     # FDD で変形した頂点からメッシュを再構成
-    mesh_ffd = Meshes( [torch.from_numpy(mesh_verts_ffd).float().to(device)], [mesh.faces_packed()] ).to(device)
-    if( args.shader == "textured_soft_phong_shader" ):
-        mesh_ffd.textures = mesh.textures
-    elif( args.shader == "soft_phong_shader" ):
-        from pytorch3d.structures import Textures
-        verts_rgb_colors = torch.ones([1, mesh.num_verts_per_mesh().item(), 3]).to(device) * 0.9
-        texture = Textures(verts_rgb=verts_rgb_colors)
-        mesh_ffd.textures = texture
+    # FFD 変形では頂点数は変化しないので、テクスチャーは再生成せずに元のメッシュと同じものを参照する
+    # （join_meshes_as_batch() で元のメッシュとバッチ化するので、シェーダーによらずテクスチャーを揃えておく）
+    mesh_ffd = Meshes( [mesh_verts_ffd], [mesh_faces] )
+    mesh_ffd.textures = mesh.textures
 
     save_mesh_obj( mesh_ffd.verts_packed(), mesh_ffd.faces_packed(), os.path.join(args.results_dir, args.exper_name, "mesh_ffd.obj" ) )
 
@@ -229,16 +238,18 @@ if __name__ == '__main__':
     cameras = OpenGLPerspectiveCameras( device = device, R = rot_matrix, T = trans_matrix )
 
     # ラスタライザーの作成
-    rasterizer = MeshRasterizer(
-        cameras = cameras, 
-        raster_settings = RasterizationSettings(
-            image_size = args.window_size, 
-            blur_radius = 0.0, 
-            faces_per_pixel = 1, 
-            bin_size = None,            # this setting controls whether naive or coarse-to-fine rasterization is used
-            max_faces_per_bin = None    # this setting is for coarse rasterization
-        )
+    # bin_size = None では画像サイズから bin サイズが自動で決まり、高速な coarse-to-fine ラスタライズが使われる（bin_size = 0 だと naive ラスタライズになる）
+    # max_faces_per_bin = None では max(10000, F/5)（F は１メッシュあたりの最大面数）になる。
+    # bin から溢れた面は警告のみで描画から欠落するので、FFD 変形で面が多くの bin にまたがっても溢れないよう pytorch3d のデフォルトのままにする
+    raster_settings = RasterizationSettings(
+        image_size = args.window_size, 
+        blur_radius = 0.0, 
+        faces_per_pixel = 1, 
+        bin_size = None,            # this setting controls whether naive or coarse-to-fine rasterization is used
+        max_faces_per_bin = None,   # this setting is for coarse rasterization
+        perspective_correct = args.perspective_correct,
     )
+    rasterizer = MeshRasterizer( cameras = cameras, raster_settings = raster_settings )
 
     # ライトの作成
     lights = PointLights( device = device, location = [[args.light_pos_x, args.light_pos_y, args.light_pos_z]] )
@@ -270,68 +281,87 @@ if __name__ == '__main__':
     camera_elev = args.camera_elev
     camera_azim = args.camera_azim
 
+    # 各ステップでの制御点の変位 [array_mu_x, array_mu_y, array_mu_z] の増分
+    ffd_delta_mu = torch.zeros_like( ffd_torch.mu )
+    ffd_delta_mu[0,0,0] = torch.tensor( [0.1, 0.0, 0.0] )
+    ffd_delta_mu[1,0,0] = torch.tensor( [0.0, 0.0, 0.0] )
+    ffd_delta_mu[0,1,0] = torch.tensor( [0.0, 0.0, 0.0] )
+    ffd_delta_mu[1,1,0] = torch.tensor( [0.0, 0.0, 0.0] )
+
+    # メッシュと FFD 変形したメッシュを１つのバッチにまとめて、１回のラスタライザー呼び出しでレンダリングする / [mesh, mesh, mesh_ffd, mesh_ffd]
+    # バッチはループの前に１回だけ作成し、ループ内では FFD 変形したメッシュの頂点のみを offset_verts_() で in-place に更新する
+    mesh_batch = join_meshes_as_batch( [mesh, mesh_ffd] ).extend(2)
+    n_verts = mesh.num_verts_per_mesh().max().item()
+    mesh_batch_offsets = torch.zeros( (4 * n_verts, 3), device = device )
+    mesh_ffd_batch_offsets = mesh_batch_offsets[2*n_verts:].view(2, n_verts, 3)     # 元のメッシュの頂点の変位は 0 のまま
+
+    # 画像やメッシュのファイル保存はバックグラウンドのスレッドで行い、次のステップのレンダリングと並行させる（同じファイルへの書き込み順を保つため１スレッド）
+    executor = ThreadPoolExecutor( max_workers = 1 )
+    save_futures = []
+
     for step in tqdm( range(args.render_steps), desc="render"):
         #-----------------------------
         # FFDでの変形＆再レンダリング
         #-----------------------------
-        ffd.array_mu_x[0,0,0] += 0.1
-        ffd.array_mu_y[0,0,0] += 0.0
-        ffd.array_mu_z[0,0,0] += 0.0
-
-        ffd.array_mu_x[1,0,0] += 0.0
-        ffd.array_mu_y[1,0,0] += 0.0
-        ffd.array_mu_z[1,0,0] += 0.0
-
-        ffd.array_mu_x[0,1,0] += 0.0
-        ffd.array_mu_y[0,1,0] += 0.0
-        ffd.array_mu_z[0,1,0] += 0.0
-
-        ffd.array_mu_x[1,1,0] += 0.0
-        ffd.array_mu_y[1,1,0] += 0.0
-        ffd.array_mu_z[1,1,0] += 0.0
-
-        mesh_verts_ffd = ffd( mesh_ffd.verts_packed().clone().cpu().numpy() )
-        mesh_ffd = Meshes( [torch.from_numpy(mesh_verts_ffd).float().to(device)], [mesh.faces_packed()] ).to(device)
-        if( args.shader == "textured_soft_phong_shader" ):
-            mesh_ffd.textures = mesh.textures
-        elif( args.shader == "soft_phong_shader" ):
-            from pytorch3d.structures import Textures
-            verts_rgb_colors = torch.ones([1, mesh.num_verts_per_mesh().item(), 3]).to(device) * 0.9
-            texture = Textures(verts_rgb=verts_rgb_colors)
-            mesh_ffd.textures = texture
-
-        save_mesh_obj( mesh_ffd.verts_packed(), mesh_ffd.faces_packed(), os.path.join(args.results_dir, args.exper_name, "mesh_ffd.obj" ) )
-
-        # メッシュのレンダリング
-        mesh_img_tsr = renderer( mesh, cameras = cameras, lights = lights, materials = materials ) * 2.0 - 1.0
-        mesh_ffd_img_tsr = renderer( mesh_ffd, cameras = cameras, lights = lights, materials = materials ) * 2.0 - 1.0
-        save_image( mesh_img_tsr.transpose(1,3).transpose(2,3), os.path.join(args.results_dir, args.exper_name, "mesh.png" ) )
-        save_image( mesh_ffd_img_tsr.transpose(1,3).transpose(2,3), os.path.join(args.results_dir, args.exper_name, "mesh_ffd.png" ) )
+        with torch.no_grad():
+            # 制御点の変位を１回の in-place 加算で更新
+            ffd_torch.mu += ffd_delta_mu
 
-        # visual images
-        visuals = [
-            [ mesh_img_tsr.transpose(1,3).transpose(2,3), mesh_ffd_img_tsr.transpose(1,3).transpose(2,3) ],
-        ]
-        board_add_images(board_train, 'render_ffd', visuals, step+1)
+            # メッシュは再構成せずに、FFD 変形による変位で頂点を in-place で更新する（テクスチャーもそのまま）
+            ffd_displacement = ffd_torch.displacement( mesh_ffd.verts_packed() )
+            mesh_ffd.offset_verts_( ffd_displacement )
+            mesh_ffd_batch_offsets.copy_( ffd_displacement.unsqueeze(0).expand(2, -1, -1) )
+            mesh_batch.offset_verts_( mesh_batch_offsets )
+
+        # obj ファイルの書き出しは一定ステップ間隔で、バックグラウンドのスレッドで行う
+        # offset_verts_() は新しい頂点テンソルを生成するので、渡した頂点は次のステップで上書きされない
+        if( (args.n_save_mesh_steps > 0 and (step+1) % args.n_save_mesh_steps == 0) or step == args.render_steps - 1 ):
+            save_futures.append( executor.submit( save_mesh_obj, mesh_ffd.verts_packed().detach(), mesh_faces, os.path.join(args.results_dir, args.exper_name, "mesh_ffd.obj" ) ) )
 
         #-----------------------------
-        # カメラの移動＆再レンダリング
+        # カメラの移動
         #-----------------------------
         camera_dist += 0.0
         camera_elev += 0.0
         camera_azim += 5.0
-        rot_matrix, trans_matrix = look_at_view_transform( dist = camera_dist, elev = camera_elev, azim = camera_azim )
-        new_cameras = OpenGLPerspectiveCameras( device = device, R = rot_matrix, T = trans_matrix )
 
-        # メッシュのレンダリング
-        mesh_img_tsr = renderer( mesh, cameras = new_cameras, lights = lights, materials = materials ) * 2.0 - 1.0
-        mesh_ffd_img_tsr = renderer( mesh_ffd, cameras = new_cameras, lights = lights, materials = materials ) * 2.0 - 1.0
-        save_image( mesh_img_tsr.transpose(1,3).transpose(2,3), os.path.join(args.results_dir, args.exper_name, "mesh_camera.png" ) )
-        save_image( mesh_ffd_img_tsr.transpose(1,3).transpose(2,3), os.path.join(args.results_dir, args.exper_name, "mesh_ffd_camera.png" ) )
+        # 元のカメラと移動後のカメラをバッチ化 / [mesh, mesh, mesh_ffd, mesh_ffd] x [元のカメラ, 移動後のカメラ, 元のカメラ, 移動後のカメラ]
+        rot_matrix, trans_matrix = look_at_view_transform( dist = [args.camera_dist, camera_dist], elev = [args.camera_elev, camera_elev], azim = [args.camera_azim, camera_azim] )
+        batch_cameras = OpenGLPerspectiveCameras( device = device, R = torch.cat([rot_matrix, rot_matrix]), T = torch.cat([trans_matrix, trans_matrix]) )
+
+        #-----------------------------
+        # 再レンダリング
+        #-----------------------------
+        mesh_batch_img_tsr = renderer( mesh_batch, cameras = batch_cameras, lights = lights, materials = materials )
+
+        # [B,H,W,C] -> [B,C,H,W] への並び替えは１回だけ行う
+        mesh_batch_img_tsr = ( mesh_batch_img_tsr * 2.0 - 1.0 ).permute(0,3,1,2).contiguous()
+        mesh_img_tsr, mesh_camera_img_tsr, mesh_ffd_img_tsr, mesh_ffd_camera_img_tsr = mesh_batch_img_tsr.split(1)
+
+        save_futures.append( executor.submit( save_image, mesh_img_tsr, os.path.join(args.results_dir, args.exper_name, "mesh.png" ) ) )
+        save_futures.append( executor.submit( save_image, mesh_ffd_img_tsr, os.path.join(args.results_dir, args.exper_name, "mesh_ffd.png" ) ) )
+        save_futures.append( executor.submit( save_image, mesh_camera_img_tsr, os.path.join(args.results_dir, args.exper_name, "mesh_camera.png" ) ) )
+        save_futures.append( executor.submit( save_image, mesh_ffd_camera_img_tsr, os.path.join(args.results_dir, args.exper_name, "mesh_ffd_camera.png" ) ) )
+
+        # 完了した保存処理の例外はここで送出する（書き込みエラーを握りつぶさない）
+        done_futures = [ future for future in save_futures if future.done() ]
+        for future in done_futures:
+            future.result()
+        save_futures = [ future for future in save_futures if future not in done_futures ]
 
         # visual images
         visuals = [
-            [ mesh_img_tsr.transpose(1,3).transpose(2,3), mesh_ffd_img_tsr.transpose(1,3).transpose(2,3) ],
+            [ mesh_img_tsr, mesh_ffd_img_tsr ],
+        ]
+        board_add_images(board_train, 'render_ffd', visuals, step+1)
+
+        visuals = [
+            [ mesh_camera_img_tsr, mesh_ffd_camera_img_tsr ],
         ]
         board_add_images(board_train, 'render_camera', visuals, step+1)
 
+    # 残りの保存処理の完了を待ち、例外があれば送出する
+    for future in save_futures:
+        future.result()
+
+    executor.shutdown( wait = True )
@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+from math import factorial
+
+import torch
+import torch.nn as nn
+
+#====================================================
+# FFD [free form deformation] 関連
+#====================================================
+class FFDTorch(nn.Module):
+    """
+    PyGeM の FFD.__call__() と同じ FFD 変形を PyTorch で行うモジュール。
+    頂点を CPU(numpy) にコピーせずに、GPU 上で Bernstein 基底のテンソル積で変形する
+    """
+    def __init__(self, array_mu, box_origin, box_edges ):
+        """
+        [args]
+            array_mu : 制御点の変位（格子の長さ単位）/ shape = [L+1,M+1,N+1,3]
+            box_origin : 格子の原点 / shape = [3]
+            box_edges : 格子の各辺のベクトル（ffd.position_vertices[1:] - ffd.position_vertices[0]）/ shape = [3,3]
+        """
+        super(FFDTorch, self).__init__()
+        self.mu = nn.Parameter( torch.tensor(array_mu, dtype=torch.float32) )
+        box_edges = torch.tensor(box_edges, dtype=torch.float32)
+        self.register_buffer( "box_origin", torch.tensor(box_origin, dtype=torch.float32) )
+        self.register_buffer( "box_edges", box_edges )
+        self.register_buffer( "box_edges_inv", torch.inverse(box_edges) )
+
+        # 各軸の Bernstein 基底の二項係数 nCi と指数 i
+        for axis, n_control_points in enumerate(self.mu.shape[0:3]):
+            degree = n_control_points - 1
+            self.register_buffer( "coeffs_{}".format(axis), torch.tensor([ factorial(degree) // (factorial(i) * factorial(degree-i)) for i in range(degree+1) ], dtype=torch.float32) )
+            self.register_buffer( "powers_{}".format(axis), torch.arange(degree+1, dtype=torch.float32) )
+
+        return
+
+    def bernstein_basis(self, s, axis):
+        """
+        Bernstein 基底関数 B_{i,n}(s) = nCi * (1-s)^(n-i) * s^i を全ての i について計算する
+        [args]
+            s : 格子の局所座標 / shape = [N]
+        [return]
+            basis : shape = [N,n+1]
+        """
+        coeffs = getattr(self, "coeffs_{}".format(axis))
+        powers = getattr(self, "powers_{}".format(axis))
+        s = s.unsqueeze(-1)
+        return coeffs * (1.0 - s) ** (powers[-1] - powers) * s ** powers
+
+    def displacement(self, verts):
+        """
+        [args]
+            verts : 変形する頂点座標 / shape = [N,3]
+        [return]
+            displacement : FFD 変形による頂点の変位 / shape = [N,3]（格子の外側の頂点の変位は 0）
+        """
+        # 格子の局所座標 [0,1]^3 に変換
+        s = torch.mm( verts - self.box_origin, self.box_edges_inv )
+        inside = ( (s >= 0.0) & (s <= 1.0) ).all(dim=1, keepdim=True)
+        s = s.clamp(0.0, 1.0)
+
+        # 各軸の Bernstein 基底のテンソル積と制御点の変位の積和
+        b_x = self.bernstein_basis( s[:,0], 0 )
+        b_y = self.bernstein_basis( s[:,1], 1 )
+        b_z = self.bernstein_basis( s[:,2], 2 )
+        displacement = torch.einsum( 'ni,nj,nk,ijkd->nd', b_x, b_y, b_z, self.mu )
+
+        # 局所座標での変位をワールド座標に戻す
+        displacement = torch.mm( displacement, self.box_edges )
+        return displacement.masked_fill( ~inside, 0.0 )
+
+    def forward(self, verts):
+        """
+        [args]
+            verts : 変形する頂点座標 / shape = [N,3]
+        [return]
+            verts_ffd : 変形後の頂点座標 / shape = [N,3]（格子の外側の頂点は変形しない）
+        """
+        return verts + self.displacement(verts)
@@ -29,6 +29,8 @@ class SMPLTailorModel(SMPLModel):
         gender = "female",
         batch_size = 1, 
         kernel_sigma = 0.01,
+        use_quantize = False,
+        use_compile = False,
         device = torch.device("cpu"),
         debug = False
     ):
@@ -113,6 +115,8 @@ class SMPLTailorModel(SMPLModel):
             cloth_type = self.cloth_type, 
             gender = self.gender, 
             kernel_sigma = self.kernel_sigma,
+            use_quantize = use_quantize,
+            use_compile = use_compile,
             device = self.device,
             debug = self.debug
         ).to(device)
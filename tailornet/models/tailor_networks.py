@@ -22,6 +22,51 @@ VALID_THETA = {
     'skirt' : [0, 1, 2, ],
 }
 
+# Lists the indices of betas and gammas which are used as inputs
+VALID_BETA = [0, 1]
+VALID_GAMMA = [0, 1]
+
+# Constant offset added to gammas of particular garment
+GAMMA_BIAS = {
+    'old-t-shirt': [0., 0., 1.5, 0.],
+}
+
+def build_theta_mask(cloth_type):
+    """
+    cloth_type: e.g. t-shirt
+    return: shape [1, 72] / 服の変形に影響する関節の theta のみ 1
+    """
+    mask = torch.zeros(24, 3)
+    mask[VALID_THETA[cloth_type], :] = 1.
+    return mask.view(1, 72)
+
+def build_beta_mask(cloth_type):
+    """
+    cloth_type: e.g. t-shirt
+    return: shape [1, 10]
+    """
+    mask = torch.zeros(1, 10)
+    mask[:, VALID_BETA] = 1.
+    return mask
+
+def build_gamma_mask(cloth_type):
+    """
+    cloth_type: e.g. t-shirt
+    return: shape [1, 4]
+    """
+    mask = torch.zeros(1, 4)
+    mask[:, VALID_GAMMA] = 1.
+    return mask
+
+def build_gamma_bias(cloth_type):
+    """
+    cloth_type: e.g. t-shirt
+    return: shape [1, 4]
+    """
+    if cloth_type in GAMMA_BIAS:
+        return torch.tensor([GAMMA_BIAS[cloth_type]], dtype=torch.float32)
+    return torch.zeros(1, 4)
+
 def mask_thetas(thetas, cloth_type):
     """
     thetas: shape [N, 72]
@@ -38,9 +83,8 @@ def mask_betas(betas, cloth_type):
     betas: shape [N, 10]
     cloth_type: e.g. t-shirt
     """
-    valid_beta = [0, 1]
     mask = torch.zeros_like(betas)
-    mask[:, valid_beta] = 1.
+    mask[:, VALID_BETA] = 1.
     return betas * mask
 
 def mask_gammas(gammas, cloth_type):
@@ -48,13 +92,12 @@ def mask_gammas(gammas, cloth_type):
     gammas: shape [N, 4]
     cloth_type: e.g. t-shirt
     """
-    valid_gamma = [0, 1]
     mask = torch.zeros_like(gammas)
-    mask[:, valid_gamma] = 1.
+    mask[:, VALID_GAMMA] = 1.
     gammas = gammas * mask
-    if cloth_type == 'old-t-shirt':
+    if cloth_type in GAMMA_BIAS:
         gammas = gammas + torch.tensor(
-            [[0., 0., 1.5, 0.]], dtype=torch.float32, device=gammas.device)
+            [GAMMA_BIAS[cloth_type]], dtype=torch.float32, device=gammas.device)
     return gammas
 
 def mask_inputs(thetas, betas, gammas, cloth_type):
@@ -88,8 +131,36 @@ class FullyConnected(nn.Module):
         ])
         self.net = nn.Sequential(*net)
 
+        # 学習済みモデルの state_dict のキー (net.0.weight, ...) を変えないように nn.Sequential はそのまま残し、
+        # forward では nn.Linear のパラメーターを直接参照する
+        self.linears = [ layer for layer in self.net if isinstance(layer, nn.Linear) ]
+        self.quantized = False
+        return
+
+    def quantize(self):
+        """
+        nn.Linear を int8 の動的量子化 Linear に置き換える（CPU 推論用）
+        """
+        torch.quantization.quantize_dynamic(self.net, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.linears = []
+        self.quantized = True
+        return
+
     def forward(self, x):
-        return self.net(x)
+        # 量子化した Linear は F.linear で直接呼び出せないので nn.Sequential で計算する
+        if( self.quantized ):
+            return self.net(x)
+
+        # nn.Sequential の各モジュールの __call__ を経由せずに F.linear を直接呼び出す。Dropout は学習時のみ適用
+        n_layers = len(self.linears)
+        for i, linear in enumerate(self.linears):
+            x = F.linear(x, linear.weight, linear.bias)
+            if( i < n_layers - 1 ):
+                x = F.relu(x, inplace=True)
+            if( i == 0 and self.training ):
+                x = F.dropout(x, p=0.2, training=True)
+
+        return x
 
 #--------------------------------
 # TailorNet のサブネットワーク
@@ -108,10 +179,18 @@ class TailorNetLF(nn.Module):
             hidden_size = params['hidden_size'] if 'hidden_size' in params else 1024, 
             num_layers = params['num_layers'] if 'num_layers' in params else 3
         )
+
+        # 入力のマスクは毎回生成せずに buffer として保持しておく
+        self.register_buffer( "theta_mask", build_theta_mask(self.cloth_type) )
+        self.register_buffer( "beta_mask", build_beta_mask(self.cloth_type) )
+        self.register_buffer( "gamma_mask", build_gamma_mask(self.cloth_type) )
+        self.register_buffer( "gamma_bias", build_gamma_bias(self.cloth_type) )
         return
 
     def forward(self, thetas, betas, gammas):
-        thetas, betas, gammas = mask_inputs(thetas, betas, gammas, cloth_type=self.cloth_type)
+        thetas = thetas * self.theta_mask
+        betas = betas * self.beta_mask
+        gammas = gammas * self.gamma_mask + self.gamma_bias
         pred_verts = self.mlp(torch.cat((thetas, betas, gammas), dim=1))
         return pred_verts
 
@@ -130,11 +209,14 @@ class TailorNetHF(nn.Module):
             hidden_size = params['hidden_size'] if 'hidden_size' in params else 1024, 
             num_layers = params['num_layers'] if 'num_layers' in params else 3
         )
+
+        # 入力のマスクは毎回生成せずに buffer として保持しておく
+        self.register_buffer( "theta_mask", build_theta_mask(self.cloth_type) )
         return
 
     def forward(self, thetas, betas=None, gammas=None):
         #print( "[{}] thetas.shape={}".format(self.__class__.__name__, thetas.shape) )
-        thetas = mask_thetas(thetas=thetas, cloth_type=self.cloth_type)
+        thetas = thetas * self.theta_mask
         #print( "[thetas] sum={}".format(torch.sum(thetas)) )    # sum= -0.34928515553474426
         pred_verts = self.mlp(thetas)
         #print( "[pred_verts] sum={}".format(torch.sum(pred_verts)) )    # sum=0.7465648651123047
@@ -154,10 +236,16 @@ class TailorNetSS2G(nn.Module):
             hidden_size = params['hidden_size'] if 'hidden_size' in params else 1024, 
             num_layers = params['num_layers'] if 'num_layers' in params else 3
         )
+
+        # 入力のマスクは毎回生成せずに buffer として保持しておく
+        self.register_buffer( "beta_mask", build_beta_mask(self.cloth_type) )
+        self.register_buffer( "gamma_mask", build_gamma_mask(self.cloth_type) )
+        self.register_buffer( "gamma_bias", build_gamma_bias(self.cloth_type) )
         return
 
     def forward(self, thetas=None, betas=None, gammas=None):
-        _, betas, gammas = mask_inputs(None, betas, gammas, self.cloth_type)
+        betas = betas * self.beta_mask
+        gammas = gammas * self.gamma_mask + self.gamma_bias
         pred_verts = self.mlp(torch.cat((betas, gammas), dim=1))
         return pred_verts
 
@@ -166,19 +254,34 @@ class TailorNetSS2G(nn.Module):
 # TailorNet
 #--------------------------------
 class TailorNet(nn.Module):
-    def __init__(self, tailornet_dataset_dir, load_checkpoints_dir, cloth_type = "old-t-shirt", gender = "female", kernel_sigma = 0.01, device = torch.device("cpu"), debug = False ):
+    def __init__(self, tailornet_dataset_dir, load_checkpoints_dir, cloth_type = "old-t-shirt", gender = "female", kernel_sigma = 0.01, use_quantize = False, use_compile = False, device = torch.device("cpu"), debug = False ):
         super(TailorNet, self).__init__()
         self.tailornet_dataset_dir = tailornet_dataset_dir
         self.load_checkpoints_dir = load_checkpoints_dir
         self.cloth_type = cloth_type
         self.gender = gender
         self.kernel_sigma = kernel_sigma
+        self.use_quantize = use_quantize
+        self.use_compile = use_compile
         self.device = device
         self.debug = debug
+        self.hf_stacked = False
 
         # 
         dataset = TailornetDataset( dataset_dir = tailornet_dataset_dir, cloth_type = cloth_type, gender = gender, shape_style_pair_list = "pivots.txt", debug = debug )
-        self.basis = dataset.unpose_v.to(self.device)
+
+        # RBF カーネルの距離計算用に basis を pivot ごとに連続した [P,V*3] の配置で保持し、
+        # その二乗ノルム（距離のスケール 1000/V 込み）を事前計算しておく
+        # addmm / einsum は型の昇格を行わないので、npy ファイルの型（float64 の場合がある）によらず float32 にキャストしておく
+        n_pivots, n_verts = dataset.unpose_v.shape[0:2]
+        basis_packed = dataset.unpose_v.reshape(n_pivots, -1).float().contiguous()
+        if( self.device.type == "cuda" ):
+            # GPU への非同期転送のため pinned memory に配置
+            basis_packed = basis_packed.pin_memory()
+
+        self.register_buffer( "basis_packed", basis_packed.to(self.device, non_blocking=True) )
+        self.dist_scale = 1000. / n_verts
+        self.register_buffer( "basis_sq_sum", (self.basis_packed ** 2).sum(-1) * self.dist_scale )
 
         #------------------
         # lf layers
@@ -202,7 +305,7 @@ class TailorNet(nn.Module):
         #------------------
         # hf layers
         #------------------
-        self.tailornet_hfs = []
+        self.tailornet_hfs = nn.ModuleList()
         for shape_idx, style_idx in dataset.shape_style_pairs:
             # load parames
             file_path = os.path.join(load_checkpoints_dir, "{}_{}_weights/tn_orig_hf/{}_{}".format(cloth_type, gender, cloth_type, gender), "{}_{}".format(shape_idx,style_idx), 'params.json')
@@ -223,6 +326,9 @@ class TailorNet(nn.Module):
 
             self.tailornet_hfs.append(tailornet_hf)
 
+        # 各 HF 層の重みを pivot 方向に stack して、1回の bmm で全 pivot を計算できるようにする
+        self.stack_hf_weights()
+
         #------------------
         # ϕ=(γ,β) から頂点変位 D への写像を行う MLP
         #------------------
@@ -242,6 +348,28 @@ class TailorNet(nn.Module):
         if( os.path.exists(file_path) ):
             load_checkpoint(self.tailornet_ss2g.mlp, device, file_path)
 
+        #------------------
+        # int8 動的量子化
+        #------------------
+        if( self.use_quantize ):
+            if( self.device.type == "cpu" ):
+                self.quantize()
+            else:
+                print( "dynamic quantization is only supported on cpu. skip quantization." )
+                self.use_quantize = False
+
+        #------------------
+        # torch.compile
+        #------------------
+        # 推論時の入力 shape は固定なので、mask -> MLP -> RBF カーネルの重み付け和までをまとめてコンパイルしてカーネルを融合する
+        self._compiled_forward = None
+        if( self.use_compile ):
+            if( hasattr(torch, "compile") ):
+                self._compiled_forward = torch.compile(self._forward_impl, mode="max-autotune", dynamic=False)
+            else:
+                print( "torch.compile is not supported in pytorch {}. skip compile.".format(torch.__version__) )
+                self.use_compile = False
+
         if( debug ):
             print( "len(self.tailornet_hfs)", len(self.tailornet_hfs) )
 
@@ -254,19 +382,103 @@ class TailorNet(nn.Module):
 
         return self.__class__.__name__ + '\n' + str(self.tailornet_lf) + '\n' + hf_str + "\n" + str(self.tailornet_ss2g)
 
-    def eval(self):
-        self.tailornet_lf.eval()
-        _ = [ tailornet_hf.eval() for tailornet_hf in self.tailornet_hfs ]
-        self.tailornet_ss2g.eval()
+    def _apply(self, fn, *args, **kwargs):
+        super(TailorNet, self)._apply(fn, *args, **kwargs)
+
+        # .to() / .cuda() などでは各 HF 層のパラメーターと stack した buffer が別々に変換されて共有が外れるので、変換後に１回だけ stack し直す
+        if( self.hf_stacked ):
+            self.stack_hf_weights()
+
+        return self
+
+    def stack_hf_weights(self):
+        """
+        各 pivot の HF 層の nn.Linear の重みとバイアスを stack して、shape = [P,out,in], [P,out] の buffer として登録する。
+        各 HF 層のパラメータは stack した buffer の view に置き換え、GPU メモリを二重に確保しないようにする
+        """
+        hf_linears = [ tailornet_hf.mlp.linears for tailornet_hf in self.tailornet_hfs ]
+
+        # params.json は pivot ごとに読み込むので、各 pivot の hidden_size / num_layers が異なる場合は stack せずに pivot ごとに計算する
+        hf_shapes = [ [ (linear.weight.shape, linear.bias.shape) for linear in linears ] for linears in hf_linears ]
+        if( any( shapes != hf_shapes[0] for shapes in hf_shapes[1:] ) ):
+            print( "the shapes of HF layers are different among pivots. skip stacking HF weights." )
+            self.hf_stacked = False
+            return
+
+        self.n_hf_layers = len(hf_linears[0])
+        for i in range(self.n_hf_layers):
+            weight = torch.stack([ linears[i].weight.data for linears in hf_linears ])
+            bias = torch.stack([ linears[i].bias.data for linears in hf_linears ])
+            for p, linears in enumerate(hf_linears):
+                linears[i].weight.data = weight[p]
+                linears[i].bias.data = bias[p]
+
+            self.register_buffer( "hf_W{}".format(i), weight )
+            self.register_buffer( "hf_b{}".format(i), bias )
+
+        self.hf_stacked = True
+        return
+
+    def quantize(self):
+        """
+        LF, HF, SS2G の各 MLP を int8 の動的量子化 Linear に置き換える。
+        量子化後の HF 層は pivot ごとに計算するので、stack した重みの buffer は削除する
+        """
+        self.tailornet_lf.mlp.quantize()
+        for tailornet_hf in self.tailornet_hfs:
+            tailornet_hf.mlp.quantize()
+        self.tailornet_ss2g.mlp.quantize()
+
+        if( self.hf_stacked ):
+            for i in range(self.n_hf_layers):
+                delattr(self, "hf_W{}".format(i))
+                delattr(self, "hf_b{}".format(i))
+            self.hf_stacked = False
+
         return
 
+    def forward_hf_pivot(self, thetas):
+        """
+        全 pivot の HF 層の MLP を pivot 方向の bmm でまとめて計算する（推論時のみ）
+        [args]
+            thetas : shape = [B,72]
+        [return]
+            pred_disp_hf_pivot : shape = [B,P,V,3]
+        """
+        batch_size = thetas.shape[0]
+        n_pivots = len(self.tailornet_hfs)
+
+        # 量子化した HF 層と学習時、HF 層の重みを stack していない場合は pivot ごとに計算する
+        # （stack した重みの buffer は .data から作成しており autograd に繋がっていないので、学習時に使うと HF 層のパラメーターに勾配が流れない）
+        # torch.stack + transpose でのコピーを避けるため、[B,P,V*3] の出力を確保して各 pivot の出力を直接書き込む
+        if( self.use_quantize or self.training or not self.hf_stacked ):
+            pred_disp_hf_pivot = thetas.new_empty( (batch_size, n_pivots, self.basis_packed.shape[1]) )
+            for p, tailornet_hf in enumerate(self.tailornet_hfs):
+                pred_disp_hf_pivot[:, p] = tailornet_hf.forward(thetas)
+            return pred_disp_hf_pivot.view(batch_size, n_pivots, -1, 3)
+
+        x = thetas * self.tailornet_hfs[0].theta_mask
+        x = x.unsqueeze(0).expand(n_pivots, batch_size, x.shape[-1])     # [P,B,72]
+        for i in range(self.n_hf_layers):
+            weight = getattr(self, "hf_W{}".format(i))
+            bias = getattr(self, "hf_b{}".format(i))
+            x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1,2))
+            if( i < self.n_hf_layers - 1 ):
+                x = F.relu(x, inplace=True)
+
+        return x.transpose(0,1).reshape(batch_size, n_pivots, -1, 3)
+
     def forward(self, betas, thetas, gammas):
+        if( self._compiled_forward is not None ):
+            return self._compiled_forward(betas, thetas, gammas)
+
+        return self._forward_impl(betas, thetas, gammas)
+
+    def _forward_impl(self, betas, thetas, gammas):
         batch_size = thetas.shape[0]
 
         # 高周波形状を計算
-        pred_disp_hf_pivot = torch.stack([
-            tailornet_hf.forward(thetas, betas, gammas).view(batch_size, -1, 3) for tailornet_hf in self.tailornet_hfs
-        ]).transpose(0, 1)
+        pred_disp_hf_pivot = self.forward_hf_pivot(thetas)
         #print( "pred_disp_hf_pivot : ", pred_disp_hf_pivot )
         #print( "pred_disp_hf_pivot.shape : ", pred_disp_hf_pivot.shape)     # torch.Size([1, 20, V, 3])
         #print( "[pred_disp_hf_pivot] sum = {}".format(torch.sum(pred_disp_hf_pivot)) )    # sum = 18.1131591796875
@@ -293,23 +505,26 @@ class TailorNet(nn.Module):
         bs = pred_disp_pivot.shape[0]
         rest_verts = self.tailornet_ss2g.forward(betas=betas, gammas=gammas).view(bs, -1, 3)
         #print( "rest_verts : ", rest_verts )        
-        #print( "self.basis : ", self.basis )
+        #print( "self.basis_packed : ", self.basis_packed )
         #print( "rest_verts.shape : ", rest_verts.shape )
-        #print( "self.basis.shape : ", self.basis.shape )
+        #print( "self.basis_packed.shape : ", self.basis_packed.shape )
         #print( "sum(rest_verts) : ", torch.sum(rest_verts) )    # tensor(-46.7538)
-        #print( "sum(self.basis) : ", torch.sum(self.basis) )    # tensor(-769.6298)
+        #print( "sum(self.basis_packed) : ", torch.sum(self.basis_packed) )    # tensor(-769.6298)
 
         # distance of given shape-style from pivots in terms of displacement
         # difference in canon pose
-        dist = rest_verts.unsqueeze(1) - self.basis.unsqueeze(0)
-        dist = (dist ** 2).sum(-1).mean(-1) * 1000.
+        # |a-b|^2 = |a|^2 + |b|^2 - 2a.b の形で計算し、[B,P,V,3] の中間テンソルを生成しないようにする
+        # 内積の項とスケールは１回の addmm（GEMM）で計算する
+        rest_verts = rest_verts.reshape(bs, -1)
+        rest_sq_sum = (rest_verts ** 2).sum(-1, keepdim=True) * self.dist_scale
+        dist = torch.addmm(rest_sq_sum + self.basis_sq_sum.unsqueeze(0), rest_verts, self.basis_packed.t(), alpha=-2.0 * self.dist_scale)
         #print( "dist : ", dist )
 
         # compute normalized RBF distance
-        weight = torch.exp(-dist/sigma)
+        # exp(-dist/sigma) の正規化は softmax で計算した方が数値的に安定（アンダーフローで nan にならない）
+        weight = torch.softmax(-dist/sigma, dim=1)
         #print( "weight : ", weight )
-        weight = weight / weight.sum(1, keepdim=True)
 
         # interpolate using weights
-        pred_disp = (pred_disp_pivot * weight.unsqueeze(-1).unsqueeze(-1)).sum(1)
+        pred_disp = torch.einsum('bp,bpvd->bvd', weight, pred_disp_pivot)
         return pred_disp
@@ -47,6 +47,8 @@ if __name__ == '__main__':
     parser.add_argument("--smpl_registration_dir", type=str, default="datasets/smpl_registrations")
     parser.add_argument("--tailornet_dataset_dir", type=str, default="datasets/tailornet_dataset")
     parser.add_argument("--kernel_sigma", type=float, default=0.01 )
+    parser.add_argument('--use_quantize', action='store_true', help="TailorNet の MLP を int8 で動的量子化する（CPU のみ）")
+    parser.add_argument('--use_compile', action='store_true', help="TailorNet の推論を torch.compile でコンパイルする（pytorch >= 2.0）")
     parser.add_argument("--texture_path", type=str, default="")
     parser.add_argument("--results_dir", type=str, default="results")
     parser.add_argument('--save_checkpoints_dir', type=str, default="checkpoints", help="モデルの保存ディレクトリ")
@@ -69,6 +71,7 @@ if __name__ == '__main__':
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
+    parser.add_argument('--use_tf32', action='store_true', help="行列積での TF32 (Tensor Core) の使用有効化")
     parser.add_argument('--detect_nan', action='store_true')
     parser.add_argument('--debug', action='store_true')
 
@@ -112,6 +115,14 @@ if __name__ == '__main__':
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
 
+    # TF32 の使用
+    if( args.use_tf32 ):
+        if( hasattr(torch.backends, "cuda") and hasattr(torch.backends.cuda, "matmul") ):
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        else:
+            print( "tf32 is not supported in pytorch {}. skip tf32.".format(torch.__version__) )
+
     np.random.seed(args.seed)
     random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -142,6 +153,8 @@ if __name__ == '__main__':
         gender = args.gender,
         batch_size = args.batch_size, 
         kernel_sigma = args.kernel_sigma,
+        use_quantize = args.use_quantize,
+        use_compile = args.use_compile,
         device = device, 
         debug = args.debug
     )